@@ -1,6 +1,16 @@
 import nox
 
-locations = "main.py", "noxfile.py", "src/mappings.py", "src/proxy.py", "src/utils.py"
+locations = (
+    "main.py",
+    "noxfile.py",
+    "src/board.py",
+    "src/mappings.py",
+    "src/pixels.py",
+    "src/proxy.py",
+    "src/session.py",
+    "src/tokens.py",
+    "src/utils.py",
+)
 
 
 # This is not run automatically
@@ -0,0 +1,405 @@
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+from websocket._exceptions import WebSocketException
+
+import src.connect as connect
+from src.mappings import ColorMapper
+
+# Side of the square tiles in which board changes are tracked
+TILE_SIZE = 64
+# Seconds to wait before connecting again after the handshake failed
+RECONNECT_DELAY = 10
+
+
+def decode_frame(frame: Image.Image, offset) -> tuple:
+    """
+    Sparse pixel updates of a diff frame
+
+    Diff frames are transparent except for the pixels that changed. Returns the
+    board coordinates (ys, xs) of every visible pixel, translated by the canvas
+    offset (dx, dy), and their color ids.
+    """
+    if frame.mode != "RGBA":
+        frame = frame.convert("RGBA")
+    pixels = np.asarray(frame)
+    ys, xs = np.nonzero(pixels[..., 3])
+    color_ids = ColorMapper.rgb_to_ids(pixels[ys, xs, :3])
+    # Drop anything that is not a palette color
+    valid = color_ids != ColorMapper.INVALID_ID
+    return (
+        (ys[valid] + offset[1]).astype(np.int32),
+        (xs[valid] + offset[0]).astype(np.int32),
+        color_ids[valid],
+    )
+
+
+class BoardSubscriber:
+    """
+    Mirror of the r/place canvas kept up to date over a single websocket
+
+    Only the canvases intersecting the region set with set_region are
+    subscribed to. The first FullFrameMessageData of every canvas seeds the
+    board, every following DiffFrameMessageData is decoded into sparse pixel
+    updates and scattered into it. Frames are downloaded concurrently but
+    applied in the order received for each canvas. When the diff chain of a
+    canvas breaks (previousTimestamp does not match the last applied frame) the
+    connection is dropped and the board is resynchronized from full frames.
+    """
+
+    def __init__(self, client, on_change=None):
+        self.client = client
+        # Called after every change applied to the board
+        self.on_change = on_change
+        self.username = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread: threading.Thread = None
+
+        # Board information (height x width color ids), allocated once and
+        # reused across resynchronizations
+        self.board: np.ndarray = None
+        # Subscription ids whose area of the board has been received
+        self.synced = set()
+        # Tiles changed since the last take_dirty (rows x columns)
+        self.dirty: np.ndarray = None
+        # Placements waiting to show up on the board, (x, y) -> (color id, event)
+        self.expected = {}
+
+        # Only canvases intersecting this (left, upper, right, lower) box are
+        # subscribed to, every canvas if None
+        self.region = None
+        self.region_changed = threading.Event()
+        # Last received canvas configuration
+        self.canvas_details: dict = None
+
+        # Frames are downloaded and decoded concurrently, then applied in order
+        self.executor = ThreadPoolExecutor(
+            max_workers=client.config_get("board_download_threads", 6),
+            thread_name_prefix="board",
+        )
+        self.apply_lock = threading.Lock()
+        self.resync = threading.Event()
+
+    def start(self, username):
+        """Start the subscription with the access token of username, if not running."""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.username = username
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def wait_ready(self):
+        """Block until the first full board is available, False if stopped first."""
+        while not self.ready.wait(timeout=1):
+            if self.client.stop_event.is_set():
+                return False
+            if not self.thread.is_alive():
+                logger.warning("Board: Subscription thread died, restarting it")
+                self.start(self.username)
+        return True
+
+    def set_region(self, coord, size):
+        """Restrict the subscription to the canvases under a rectangle."""
+        with self.lock:
+            self.region = (
+                int(coord[0]),
+                int(coord[1]),
+                int(coord[0] + size[0]),
+                int(coord[1] + size[1]),
+            )
+        # Don't serve the board until newly covered canvases are received
+        if self.canvas_details is not None and not (
+            self._wanted_canvases(self.canvas_details).keys() <= self.synced
+        ):
+            self.ready.clear()
+        self.region_changed.set()
+
+    def view(self, box):
+        """
+        Board inside box (left, upper, right, lower), without copying
+
+        The returned view keeps following the updates applied to the board.
+        """
+        left, upper, right, lower = box
+        with self.lock:
+            return self.board[upper:lower, left:right]
+
+    def color_at(self, coord):
+        """Color ids of the board pixels at coord (x, y), or at coords (... x 2)."""
+        coord = np.asarray(coord)
+        with self.lock:
+            return self.board[coord[..., 1], coord[..., 0]]
+
+    def take_dirty(self, box):
+        """
+        Areas of box (left, upper, right, lower) changed since the last call
+
+        Returns (rows, columns) slices relative to box, one per changed tile.
+        Every tile is marked clean afterwards.
+        """
+        left, upper, right, lower = box
+        with self.lock:
+            dirty = self.dirty[
+                upper // TILE_SIZE : -(-lower // TILE_SIZE),
+                left // TILE_SIZE : -(-right // TILE_SIZE),
+            ].copy()
+            self.dirty[...] = False
+
+        areas = []
+        for tile_row, tile_column in np.argwhere(dirty):
+            top = (upper // TILE_SIZE + tile_row) * TILE_SIZE - upper
+            start = (left // TILE_SIZE + tile_column) * TILE_SIZE - left
+            areas.append(
+                (
+                    slice(max(top, 0), min(top + TILE_SIZE, lower - upper)),
+                    slice(max(start, 0), min(start + TILE_SIZE, right - left)),
+                )
+            )
+        return areas
+
+    def expect(self, coord, color_id) -> threading.Event:
+        """
+        Wait for the board pixel at coord (x, y) to become color_id
+
+        Returns an event set once a received frame shows the pixel with that
+        color. Stop waiting with forget.
+        """
+        event = threading.Event()
+        with self.lock:
+            self.expected[(int(coord[0]), int(coord[1]))] = (int(color_id), event)
+        return event
+
+    def forget(self, coord):
+        """Stop waiting for the pixel at coord (x, y), see expect."""
+        with self.lock:
+            self.expected.pop((int(coord[0]), int(coord[1])), None)
+
+    def _confirm(self):
+        """Set the events of the expected pixels now on the board, lock held."""
+        for (x, y), (color_id, event) in list(self.expected.items()):
+            if self.board[y, x] == color_id:
+                event.set()
+                del self.expected[(x, y)]
+
+    def touch(self, coord):
+        """Mark the tile of the pixel at coord (x, y) as changed."""
+        with self.lock:
+            if self.dirty is not None:
+                self._mark_dirty(coord[1], coord[0], coord[1] + 1, coord[0] + 1)
+
+    def _mark_dirty(self, top, left, bottom, right):
+        self.dirty[
+            top // TILE_SIZE : -(-bottom // TILE_SIZE),
+            left // TILE_SIZE : -(-right // TILE_SIZE),
+        ] = True
+
+    def apply(self, ys, xs, color_ids):
+        """Scatter sparse pixel updates into the board."""
+        with self.lock:
+            self.board[ys, xs] = color_ids
+            self.dirty[ys // TILE_SIZE, xs // TILE_SIZE] = True
+            if self.expected:
+                self._confirm()
+
+    def _run(self):
+        while not self.client.stop_event.is_set():
+            try:
+                ws = connect.connect_websocket(
+                    self.client, self.client.access_tokens[self.username]
+                )
+            except WebSocketException as e:
+                logger.warning(
+                    "Board: Failed to connect: {}, trying again in {} seconds",
+                    e,
+                    RECONNECT_DELAY,
+                )
+                self.client.stop_event.wait(RECONNECT_DELAY)
+                continue
+            if ws is None:
+                return
+            try:
+                self._subscribe(ws)
+            except (WebSocketException, OSError, ValueError) as e:
+                logger.warning("Board: Subscription lost: {}", e)
+            finally:
+                ws.close()
+                # The board is stale until the full frames are received again
+                self.ready.clear()
+                self.synced.clear()
+            logger.info("Board: Resynchronizing board")
+
+    def _wanted_canvases(self, canvas_details):
+        """Subscription id -> offset of every canvas intersecting the region."""
+        width = canvas_details["canvasWidth"]
+        height = canvas_details["canvasHeight"]
+        with self.lock:
+            region = self.region
+        return {
+            connect.canvas_subscription_id(c["index"]): (c["dx"], c["dy"])
+            for c in canvas_details["canvasConfigurations"]
+            if region is None
+            or (
+                c["dx"] < region[2]
+                and c["dx"] + width > region[0]
+                and c["dy"] < region[3]
+                and c["dy"] + height > region[1]
+            )
+        }
+
+    def _resubscribe(self, ws, canvas_details, offsets, timestamps):
+        """Align the canvas subscriptions of ws with the current region."""
+        wanted = self._wanted_canvases(canvas_details)
+        for subscription_id in offsets.keys() - wanted.keys():
+            logger.debug("Board: Closing canvas socket {}", subscription_id)
+            connect.unsubscribe(ws, subscription_id)
+            del offsets[subscription_id]
+            timestamps.pop(subscription_id, None)
+            # the area of this canvas won't be kept up to date anymore
+            self.synced.discard(subscription_id)
+        for configuration in canvas_details["canvasConfigurations"]:
+            subscription_id = connect.canvas_subscription_id(configuration["index"])
+            if subscription_id in wanted and subscription_id not in offsets:
+                connect.subscribe_canvas(self.client, ws, configuration["index"])
+                offsets[subscription_id] = wanted[subscription_id]
+        logger.debug("Board: A total of {} canvas sockets opened", len(offsets))
+
+        if offsets.keys() <= self.synced:
+            self.ready.set()
+        else:
+            self.ready.clear()
+
+    def _fetch(self, data, offset):
+        """Download and decode a frame, runs in the executor."""
+        frame = connect.get_frame(self.client, data["name"])
+        if frame is None:
+            return None
+        if data["__typename"] == "FullFrameMessageData":
+            if frame.mode not in ("RGB", "RGBA"):
+                frame = frame.convert("RGB")
+            return np.asarray(frame)[..., :3]
+        return decode_frame(frame, offset)
+
+    def _drain(self, pending, subscription_id, offsets, future=None):
+        """Apply the finished frames at the head of a canvas queue, in order."""
+        with self.apply_lock:
+            if subscription_id not in offsets:
+                pending.clear()  # canvas unsubscribed
+                return
+            while pending and pending[0][1].done():
+                data, future = pending.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("Board: Failed to get frame: {}", e)
+                    result = None
+                if result is None:
+                    # a missing frame breaks the chain of the canvas
+                    pending.clear()
+                    self.resync.set()
+                    return
+
+                if data["__typename"] == "FullFrameMessageData":
+                    dx, dy = offsets[subscription_id]
+                    # decoded straight into the board buffer
+                    bottom, right = dy + result.shape[0], dx + result.shape[1]
+                    with self.lock:
+                        ColorMapper.rgb_to_ids(
+                            result, out=self.board[dy:bottom, dx:right]
+                        )
+                        self._mark_dirty(dy, dx, bottom, right)
+                        if self.expected:
+                            self._confirm()
+                    self.synced.add(subscription_id)
+                    if offsets.keys() <= self.synced and not self.ready.is_set():
+                        logger.info("Board: Board synchronized")
+                        self.ready.set()
+                else:
+                    self.apply(*result)
+                if self.on_change is not None:
+                    self.on_change()
+
+    def _subscribe(self, ws):
+        canvas_details = connect.subscribe_configuration(self.client, ws)
+        if canvas_details is None:
+            return
+        self.canvas_details = canvas_details
+        configurations = canvas_details["canvasConfigurations"]
+
+        width = max(c["dx"] for c in configurations) + canvas_details["canvasWidth"]
+        height = max(c["dy"] for c in configurations) + canvas_details["canvasHeight"]
+        with self.lock:
+            if self.board is None or self.board.shape[:2] != (height, width):
+                logger.debug("Board: New board size: {}x{}", width, height)
+                self.board = np.full(
+                    (height, width), ColorMapper.INVALID_ID, dtype=np.uint8
+                )
+                self.dirty = np.ones(
+                    (-(-height // TILE_SIZE), -(-width // TILE_SIZE)), dtype=bool
+                )
+                self.synced.clear()
+
+        # subscription id -> canvas offset
+        offsets = {}
+        # subscription id -> timestamp of the last received frame
+        timestamps = {}
+        # subscription id -> frames being downloaded, in the order received
+        pendings = {}
+        self.resync.clear()
+        self.region_changed.set()
+        try:
+            while not self.client.stop_event.is_set() and not self.resync.is_set():
+                if self.region_changed.is_set():
+                    self.region_changed.clear()
+                    self._resubscribe(ws, canvas_details, offsets, timestamps)
+
+                raw = ws.recv()
+                if not raw:
+                    logger.warning("Board: Connection closed by the server")
+                    return
+                message = json.loads(raw)
+                if message["type"] != "data":
+                    continue
+                subscription_id = int(message["id"])
+                if subscription_id not in offsets:
+                    continue
+                data = message["payload"]["data"]["subscribe"]["data"]
+
+                if data["__typename"] == "FullFrameMessageData":
+                    timestamps[subscription_id] = data["timestamp"]
+
+                elif data["__typename"] == "DiffFrameMessageData":
+                    # Diffs received before the full frame are already included in it
+                    if subscription_id not in timestamps:
+                        continue
+                    if data["previousTimestamp"] != timestamps[subscription_id]:
+                        logger.warning(
+                            "Board: Diff chain of canvas socket {} broken",
+                            subscription_id,
+                        )
+                        return
+                    timestamps[subscription_id] = data["currentTimestamp"]
+
+                else:
+                    continue
+
+                with self.apply_lock:
+                    pending = pendings.setdefault(subscription_id, deque())
+                    future = self.executor.submit(
+                        self._fetch, data, offsets[subscription_id]
+                    )
+                    pending.append((data, future))
+                future.add_done_callback(
+                    partial(self._drain, pending, subscription_id, offsets)
+                )
+        finally:
+            # Frames still downloading belong to the dropped connection
+            with self.apply_lock:
+                for pending in pendings.values():
+                    pending.clear()
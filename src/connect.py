@@ -1,6 +1,6 @@
 import json
-import requests
 import time
+from functools import lru_cache
 from io import BytesIO
 from http import HTTPStatus
 from websocket import create_connection
@@ -11,27 +11,14 @@ from loguru import logger
 from bs4 import BeautifulSoup
 
 import src.proxy as proxy
+import src.session as session
+import src.tokens as tokens
 from src.mappings import ColorMapper
 
 
-def set_pixel(self, coord, color_index, canvas_index, access_token):
-    # ACCEPTS REDDIT API COORD
-    url = "https://gql-realtime-2.reddit.com/query"
+GQL_URL = "https://gql-realtime-2.reddit.com/query"
 
-    payload = json.dumps(
-        {
-            "operationName": "setPixel",
-            "variables": {
-                "input": {
-                    "actionName": "r/replace:set_pixel",
-                    "PixelMessageData": {
-                        "coordinate": {"x": int(coord[0]), "y": int(coord[1])},
-                        "colorIndex": int(color_index),
-                        "canvasIndex": int(canvas_index),
-                    },
-                }
-            },
-            "query": """mutation setPixel($input: ActInput!) {
+SET_PIXEL_QUERY = """mutation setPixel($input: ActInput!) {
                     act(input: $input) {
                         data {
                             ... on BasicMessage {
@@ -54,9 +41,29 @@ def set_pixel(self, coord, color_index, canvas_index, access_token):
                         __typename
                     }
                 }
-            """,
-        }
+            """
+
+PIXEL_HISTORY_QUERY = "mutation pixelHistory($input: ActInput!) {\n  act(input: $input) {\n    data {\n      ... on BasicMessage {\n        id\n        data {\n          ... on GetTileHistoryResponseMessageData {\n            lastModifiedTimestamp\n            userInfo {\n              userID\n              username\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+
+
+@lru_cache(maxsize=None)
+def _encode_query(query):
+    return json.dumps(query)
+
+
+# Serialized GraphQL request body, the (large) query is only serialized once
+def graphql_body(operation_name, variables, query):
+    return '{"operationName": %s, "variables": %s, "query": %s}' % (
+        json.dumps(operation_name),
+        json.dumps(variables),
+        _encode_query(query),
     )
+
+
+# Post a GraphQL request over the keep-alive session of the worker and proxy
+def post_graphql(self, username, access_token, body):
+    proxies = proxy.get_random_proxy(self, username=None)
+    key = ("gql", username, tuple(sorted(proxies.items())) if proxies else None)
     headers = {
         "origin": "https://garlic-bread.reddit.com",
         "referer": "https://garlic-bread.reddit.com/",
@@ -64,210 +71,196 @@ def set_pixel(self, coord, color_index, canvas_index, access_token):
         "Authorization": "Bearer " + access_token,
         "Content-Type": "application/json",
     }
+    return session.get_session(key).post(
+        GQL_URL, headers=headers, data=body, proxies=proxies
+    )
 
-    response = requests.request(
-        "POST",
-        url,
-        headers=headers,
-        data=payload,
-        proxies=proxy.get_random_proxy(self, username=None),
+
+def set_pixel(self, coord, color_index, canvas_index, access_token, username=None):
+    # ACCEPTS REDDIT API COORD
+    payload = graphql_body(
+        "setPixel",
+        {
+            "input": {
+                "actionName": "r/replace:set_pixel",
+                "PixelMessageData": {
+                    "coordinate": {"x": int(coord[0]), "y": int(coord[1])},
+                    "colorIndex": int(color_index),
+                    "canvasIndex": int(canvas_index),
+                },
+            }
+        },
+        SET_PIXEL_QUERY,
     )
 
-    return response
-
-def get_board(self, access_token_in):
-        logger.debug("Connecting and obtaining board images")
-        while not self.stop_event.is_set():
-            try:
-                ws = create_connection(
-                    "wss://gql-realtime-2.reddit.com/query",
-                    origin="https://garlic-bread.reddit.com",
-                    sslopt={"cert_reqs": ssl.CERT_NONE},
-                    
-                )
-                break
-            except Exception:
-                logger.error(
-                    "Failed to connect to websocket, trying again in 30 seconds..."
-                )
-                time.sleep(30)
-
-        ws.send(
-            json.dumps(
-                {
-                    "type": "connection_init",
-                    "payload": {"Authorization": "Bearer " + access_token_in},
-                }
+    return post_graphql(self, username, access_token, payload)
+
+def connect_websocket(self, access_token):
+    logger.debug("Connecting to WebSocket server")
+    while not self.stop_event.is_set():
+        try:
+            ws = create_connection(
+                "wss://gql-realtime-2.reddit.com/query",
+                origin="https://garlic-bread.reddit.com",
+                sslopt={"cert_reqs": ssl.CERT_NONE},
             )
+            break
+        except Exception:
+            logger.error(
+                "Failed to connect to websocket, trying again in 30 seconds..."
+            )
+            time.sleep(30)
+    else:
+        return None
+
+    ws.send(
+        json.dumps(
+            {
+                "type": "connection_init",
+                "payload": {"Authorization": "Bearer " + access_token},
+            }
         )
-        while not self.stop_event.is_set():
-            try:
-                msg = ws.recv()
-            except WebSocketConnectionClosedException as e:
-                logger.error(e)
-                continue
-            if msg is None:
-                logger.error("Reddit failed to acknowledge connection_init")
-                exit()
-            if msg.startswith('{"type":"connection_ack"}'):
-                logger.debug("Connected to WebSocket server")
-                break
-        logger.debug("Obtaining Canvas information")
-        ws.send(
-            json.dumps(
-                {
-                    "id": "1",
-                    "type": "start",
-                    "payload": {
-                        "variables": {
-                            "input": {
-                                "channel": {
-                                    "teamOwner": "GARLICBREAD",
-                                    "category": "CONFIG",
-                                }
+    )
+    while not self.stop_event.is_set():
+        try:
+            msg = ws.recv()
+        except WebSocketConnectionClosedException:
+            msg = None
+        if not msg:
+            # closed by the server, e.g. the access token was rejected
+            ws.close()
+            raise WebSocketConnectionClosedException(
+                "Reddit failed to acknowledge connection_init"
+            )
+        if msg.startswith('{"type":"connection_ack"}'):
+            logger.debug("Connected to WebSocket server")
+            break
+    else:
+        ws.close()
+        return None
+    return ws
+
+
+def subscribe_configuration(self, ws):
+    logger.debug("Obtaining Canvas information")
+    ws.send(
+        json.dumps(
+            {
+                "id": "1",
+                "type": "start",
+                "payload": {
+                    "variables": {
+                        "input": {
+                            "channel": {
+                                "teamOwner": "GARLICBREAD",
+                                "category": "CONFIG",
                             }
-                        },
-                        "extensions": {},
-                        "operationName": "configuration",
-                        "query": "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
+                        }
                     },
-                }
-            )
+                    "extensions": {},
+                    "operationName": "configuration",
+                    "query": "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
+                },
+            }
         )
+    )
 
-        while not self.stop_event.is_set():
-            canvas_payload = json.loads(ws.recv())
-            if canvas_payload["type"] == "data":
-                canvas_details = canvas_payload["payload"]["data"]["subscribe"]["data"]
-                logger.debug("Canvas config: {}", canvas_payload)
-                break
+    while not self.stop_event.is_set():
+        canvas_payload = json.loads(ws.recv())
+        if canvas_payload["type"] == "data":
+            canvas_details = canvas_payload["payload"]["data"]["subscribe"]["data"]
+            logger.debug("Canvas config: {}", canvas_payload)
+            break
+    else:
+        return None
 
-        canvas_sockets = []
-
-        canvas_count = len(canvas_details["canvasConfigurations"])
-
-        # Update color map
-        colors = canvas_details["colorPalette"]["colors"]
-        ColorMapper.update_colors(len(colors))
-        self.logger.debug("Colors: {}", colors)
-
-        for i in range(0, canvas_count):
-            canvas_sockets.append(2 + i)
-            logger.debug("Creating canvas socket {}", canvas_sockets[i])
-
-            ws.send(
-                json.dumps(
-                    {
-                        "id": str(2 + i),
-                        "type": "start",
-                        "payload": {
-                            "variables": {
-                                "input": {
-                                    "channel": {
-                                        "teamOwner": "GARLICBREAD",
-                                        "category": "CANVAS",
-                                        "tag": str(i),
-                                    }
-                                }
-                            },
-                            "extensions": {},
-                            "operationName": "replace",
-                            "query": """subscription replace($input: SubscribeInput!) {
-                                    subscribe(input: $input) {
-                                        id
-                                        ... on BasicMessage {
-                                            data {
-                                                __typename
-                                                ... on FullFrameMessageData {
-                                                    __typename
-                                                    name
-                                                    timestamp
-                                                }
-                                                ... on DiffFrameMessageData {
-                                                    __typename
-                                                    name
-                                                    currentTimestamp
-                                                    previousTimestamp
-                                                }
-                                            }
-                                            __typename
-                                        }
-                                        __typename
-                                    }
-                                }""",
-                        },
-                    }
-                )
-            )
+    # Update color map
+    colors = canvas_details["colorPalette"]["colors"]
+    ColorMapper.update_colors(len(colors))
+    self.logger.debug("Colors: {}", colors)
 
-        imgs = []
-        logger.debug("A total of {} canvas sockets opened", len(canvas_sockets))
-
-        while len(canvas_sockets) > 0:
-            temp = json.loads(ws.recv())
-            logger.debug("Waiting for WebSocket message")
-
-            if temp["type"] == "data":
-                logger.debug(f"Received WebSocket data type message")
-                msg = temp["payload"]["data"]["subscribe"]
-
-                if msg["data"]["__typename"] == "FullFrameMessageData":
-                    logger.debug("Received full frame message")
-                    img_id = int(temp["id"])
-                    logger.debug("Image ID: {}", img_id)
-
-                    if img_id in canvas_sockets:
-                        logger.debug("Getting image: {}", msg["data"]["name"])
-                        img = requests.get(msg["data"]["name"], stream=True,
-                                           proxies=proxy.get_random_proxy(self, username=None),)
-                        if not img.status_code == 404:
-                            imgs.append(
-                                [
-                                    img_id,
-                                    Image.open(
-                                        BytesIO(img.content)
-                                    ),
-                                ]
-                            )
-                            canvas_sockets.remove(img_id)
-                            logger.debug(
-                                "Canvas sockets remaining: {}", len(canvas_sockets)
-                            )
-                        else:
-                            logger.debug("Received wrong image")
-                            canvas_sockets.remove(img_id)
-
-        for i in range(0, canvas_count - 1):
-            ws.send(json.dumps({"id": str(2 + i), "type": "stop"}))
+    return canvas_details
 
-        ws.close()
 
-        new_img_width = (
-            max(map(lambda x: x["dx"], canvas_details["canvasConfigurations"]))
-            + canvas_details["canvasWidth"]
-        )
-        logger.debug("New image width: {}", new_img_width)
+# Canvas subscriptions use the canvas index shifted by the configuration id
+def canvas_subscription_id(canvas_index):
+    return 2 + canvas_index
+
+
+def subscribe_canvas(self, ws, canvas_index):
+    subscription_id = canvas_subscription_id(canvas_index)
+    logger.debug("Creating canvas socket {}", subscription_id)
 
-        new_img_height = (
-            max(map(lambda x: x["dy"], canvas_details["canvasConfigurations"]))
-            + canvas_details["canvasHeight"]
+    ws.send(
+        json.dumps(
+            {
+                "id": str(subscription_id),
+                "type": "start",
+                "payload": {
+                    "variables": {
+                        "input": {
+                            "channel": {
+                                "teamOwner": "GARLICBREAD",
+                                "category": "CANVAS",
+                                "tag": str(canvas_index),
+                            }
+                        }
+                    },
+                    "extensions": {},
+                    "operationName": "replace",
+                    "query": """subscription replace($input: SubscribeInput!) {
+                            subscribe(input: $input) {
+                                id
+                                ... on BasicMessage {
+                                    data {
+                                        __typename
+                                        ... on FullFrameMessageData {
+                                            __typename
+                                            name
+                                            timestamp
+                                        }
+                                        ... on DiffFrameMessageData {
+                                            __typename
+                                            name
+                                            currentTimestamp
+                                            previousTimestamp
+                                        }
+                                    }
+                                    __typename
+                                }
+                                __typename
+                            }
+                        }""",
+                },
+            }
         )
-        logger.debug("New image height: {}", new_img_height)
+    )
+    return subscription_id
 
-        new_img = Image.new("RGB", (new_img_width, new_img_height))
 
-        for idx, img in enumerate(sorted(imgs, key=lambda x: x[0])):
-            logger.debug("Adding image (ID {}): {}", img[0], img[1])
-            dx_offset = int(canvas_details["canvasConfigurations"][idx]["dx"])
-            dy_offset = int(canvas_details["canvasConfigurations"][idx]["dy"])
-            new_img.paste(img[1], (dx_offset, dy_offset))
+def unsubscribe(ws, subscription_id):
+    ws.send(json.dumps({"id": str(subscription_id), "type": "stop"}))
+
+
+def get_frame(self, url):
+    logger.debug("Getting image: {}", url)
+    img = session.get_session("frames").get(
+        url,
+        proxies=proxy.get_random_proxy(self, username=None),
+        timeout=self.config_get("board_timeout", 10),
+    )
+    if img.status_code == 404:
+        logger.debug("Received wrong image")
+        return None
+    return Image.open(BytesIO(img.content))
 
-        return new_img
 
 def login(self, username, password, index, current_time):
     while not self.stop_event.is_set():
         try:
-            client = requests.Session()
+            # Connections are kept between logins, cookies are not
+            client = session.get_session(("login", username))
+            client.cookies.clear()
             client.proxies = proxy.get_random_proxy(self, username)
             client.headers.update(
                 {
@@ -359,43 +352,27 @@ def login(self, username, password, index, current_time):
         "Received new access token: {}************",
         self.access_tokens.get(index)[:5],
     )
+    tokens.save_access_token(self, index)
 
 def check(self, coord, color_index, canvas_index, user):
     logger.debug('Thread {}" Self-checking if placement went through', user)
 
-    url = "https://gql-realtime-2.reddit.com/query"
-    payload = json.dumps(
+    payload = graphql_body(
+        "pixelHistory",
         {
-            "operationName": "pixelHistory",
-            "variables": {
-                "input": {
-                    "actionName": "r/replace:get_tile_history",
-                    "PixelMessageData": {
-                        "coordinate": {"x": int(coord[0]), "y": int(coord[1])},
-                        "colorIndex": int(color_index),
-                        "canvasIndex": int(canvas_index),
-                    },
-                }
-            },
-            "query": "mutation pixelHistory($input: ActInput!) {\n  act(input: $input) {\n    data {\n      ... on BasicMessage {\n        id\n        data {\n          ... on GetTileHistoryResponseMessageData {\n            lastModifiedTimestamp\n            userInfo {\n              userID\n              username\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-        }
+            "input": {
+                "actionName": "r/replace:get_tile_history",
+                "PixelMessageData": {
+                    "coordinate": {"x": int(coord[0]), "y": int(coord[1])},
+                    "colorIndex": int(color_index),
+                    "canvasIndex": int(canvas_index),
+                },
+            }
+        },
+        PIXEL_HISTORY_QUERY,
     )
-    headers = {
-        "origin": "https://garlic-bread.reddit.com",
-        "referer": "https://garlic-bread.reddit.com/",
-        "apollographql-client-name": "garlic-bread",
-        "Authorization": "Bearer " + self.access_tokens[user],
-        "Content-Type": "application/json",
-    }
 
-    time.sleep(3)
-    response = requests.request(
-        "POST",
-        url,
-        headers=headers,
-        data=payload,
-        proxies=proxy.get_random_proxy(self, username=None),
-    )
+    response = post_graphql(self, user, self.access_tokens[user], payload)
 
     try: 
         pixel_user = response.json()['data']['act']['data'][0]['data']['userInfo']['username']
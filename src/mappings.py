@@ -1,3 +1,8 @@
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from PIL import ImageColor
 
@@ -114,6 +119,62 @@ class ColorMapper:
         for color_hex in COLOR_MAP
     ])
 
+    # rgb value of every pixel color id, indexed by color id
+    FULL_COLORS = np.array([
+        ImageColor.getcolor(color_hex, "RGB")
+        for color_hex in FULL_COLOR_MAP
+    ], dtype=np.uint8)
+
+    # color id of rgb values outside of the palette and of transparent pixels
+    INVALID_ID = 255
+
+    # rgb value of every possible color id, black for unknown ids
+    _ID_TO_RGB = np.zeros((256, 3), dtype=np.uint8)
+    _ID_TO_RGB[:len(FULL_COLORS)] = FULL_COLORS
+
+    # color id of every packed rgb value (see pack_rgb), INVALID_ID if not in palette
+    _RGB_TO_ID = np.full(1 << 24, INVALID_ID, dtype=np.uint8)
+    _RGB_TO_ID[
+        (FULL_COLORS[:, 0].astype(np.uint32) << 16)
+        | (FULL_COLORS[:, 1].astype(np.uint32) << 8)
+        | FULL_COLORS[:, 2]
+    ] = np.arange(len(FULL_COLORS))
+
+    # Directory where the color lookup tables are cached, memory only if None
+    LUT_DIR = None
+    # Color lookup table of each palette, see lookup_table
+    _LUTS = {}
+    # Lookup table entry not computed yet
+    _UNSET = 255
+
+    # Peak size in bytes of the temporary arrays of closest_colors and
+    # correct_image, larger inputs are processed in chunks
+    MEMORY_BUDGET = 256 << 20
+    # Threads computing the chunks of closest_colors
+    THREADS = 1
+    # Bytes of temporaries per (color, palette color) pair in closest_colors,
+    # for each metric
+    _PAIR_BYTES = {
+        "redmean": 128,
+        "euclidean": 64,
+        "cie76": 64,
+        "ciede2000": 512,
+    }
+
+    # Color difference used to match colors to the palette, see closest_colors
+    METRIC = "redmean"
+
+    # sRGB (D65) to CIE XYZ
+    _RGB_TO_XYZ = np.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ])
+    # D65 reference white
+    _WHITE = np.array([0.95047, 1.0, 1.08883])
+    # Bytes of temporaries per pixel in correct_image
+    _PIXEL_BYTES = 48
+
     @staticmethod
     def update_colors(colors_count: int):
         if colors_count != ColorMapper.COLORS.shape[0]:
@@ -134,9 +195,38 @@ class ColorMapper:
     
     @staticmethod
     def rgb_to_id(rgb: np.ndarray):
-        return ColorMapper.FULL_COLOR_MAP[
-            ColorMapper.rgb_to_hex(rgb)
-        ]
+        """Pixel color id of a single rgb value, INVALID_ID if not in palette."""
+        return int(ColorMapper.rgb_to_ids(np.asarray(rgb)))
+
+    @staticmethod
+    def pack_rgb(rgb: np.ndarray) -> np.ndarray:
+        """Pack rgb values (... x 3) into 24-bit integers (...)."""
+        return (
+            (rgb[..., 0].astype(np.uint32) << 16)
+            | (rgb[..., 1].astype(np.uint32) << 8)
+            | rgb[..., 2]
+        )
+
+    @staticmethod
+    def rgb_to_ids(rgb: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Convert rgb values (... x 3) to pixel color ids, INVALID_ID if not in palette
+
+        The ids are written into out (... uint8) when given, e.g. a board slice.
+        """
+        return np.take(ColorMapper._RGB_TO_ID, ColorMapper.pack_rgb(rgb), out=out)
+
+    @staticmethod
+    def ids_to_rgb(color_ids: np.ndarray) -> np.ndarray:
+        """Convert pixel color ids (...) to rgb values (... x 3)."""
+        return ColorMapper._ID_TO_RGB[color_ids]
+
+    @staticmethod
+    def image_to_ids(image: np.ndarray) -> np.ndarray:
+        """Convert a palette rgba image (m x n x 4) to color ids, INVALID_ID if not opaque."""
+        color_ids = ColorMapper.rgb_to_ids(image[..., :3])
+        color_ids[image[..., 3] != 255] = ColorMapper.INVALID_ID
+        return color_ids
 
     @staticmethod
     def rgb_to_hex(rgb: np.ndarray):
@@ -151,10 +241,76 @@ class ColorMapper:
         return "Invalid Color ({})".format(str(color_id))
 
     @staticmethod
-    def correct_image(target_image: np.ndarray) -> np.ndarray:
+    def unpack_rgb(packed: np.ndarray) -> np.ndarray:
+        """Unpack 24-bit integers (...) into rgb values (... x 3)."""
+        return np.stack(
+            [(packed >> 16) & 255, (packed >> 8) & 255, packed & 255], axis=-1
+        ).astype(np.uint8)
+
+    @staticmethod
+    def closest_colors(rgb: np.ndarray, colors: np.ndarray = None) -> np.ndarray:
         """
-        Find the closest rgb color from palette to a target rgb color
-        
+        Find the closest rgb color from palette to target rgb colors (N x 3)
+        Returns the position of the colors in colors (N), COLORS if None
+
+        METRIC selects the color difference:
+        - redmean: weighted euclidean distance approximating perception in sRGB
+        - euclidean: plain distance in sRGB
+        - cie76: euclidean distance in CIELAB
+        - ciede2000: CIEDE2000 difference in CIELAB, the most accurate
+
+        Colors are processed in chunks keeping the temporaries within
+        MEMORY_BUDGET, spread over THREADS threads.
+        """
+        if ColorMapper.METRIC not in ColorMapper._PAIR_BYTES:
+            raise ValueError(f"Unknown color metric: {ColorMapper.METRIC}")
+        if colors is None:
+            colors = ColorMapper.COLORS
+        palette_size = len(colors)
+        threads = max(int(ColorMapper.THREADS), 1)
+        # Every thread holds the temporaries of one chunk
+        chunk = max(
+            ColorMapper.MEMORY_BUDGET
+            // (
+                threads
+                * palette_size
+                * ColorMapper._PAIR_BYTES[ColorMapper.METRIC]
+            ),
+            1,
+        )
+        if len(rgb) <= chunk:
+            return ColorMapper._closest_colors(rgb, colors)
+
+        positions = np.empty(len(rgb), dtype=np.intp)
+
+        def process(start):
+            positions[start:start + chunk] = ColorMapper._closest_colors(
+                rgb[start:start + chunk], colors
+            )
+
+        starts = range(0, len(rgb), chunk)
+        if threads == 1:
+            for start in starts:
+                process(start)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                # consume the results to raise exceptions
+                list(executor.map(process, starts))
+        return positions
+
+    @staticmethod
+    def _closest_colors(rgb: np.ndarray, colors: np.ndarray) -> np.ndarray:
+        """closest_colors of a single chunk."""
+        distances = getattr(ColorMapper, f"_{ColorMapper.METRIC}_distances")
+        # palette color with minimum distance to the corresponding color
+        # (N x p) -> (N)
+        return np.argmin(distances(rgb, colors), axis=-1)
+
+    @staticmethod
+    def _redmean_distances(rgb: np.ndarray, colors: np.ndarray) -> np.ndarray:
+        """
+        Redmean distance between colors (N x 3) and the palette colors (N x p)
+
         Old method is to just take the linear distance from color to the palette options
         This is bad when the template does not have accurate colors as it does not model
         human perception and color contributions to brightness
@@ -166,30 +322,215 @@ class ColorMapper:
         Otherwise provides
         """
 
-        corrected_image = target_image
-        
-        # Image dimension (m x n x 3)
+        # Colors dimension (N x 3)
         # Palette dimension (p x 3)
-        
+
         # mean_r: mean of red channel with each palette color
-        # (m x n x 1) + (1 x 1 x p) -> (m x n x p)
-        mean_r = (target_image[...,None,0]
-                  + ColorMapper.COLORS[None,None,:,0]) / 220
-        # delta_rgb: difference between each pixel and each palette color
-        # (m x n x 1 x 3) - (1 x 1 x p x 3) -> (m x n x p x 3)
-        delta_rgb = (target_image[...,None,:3]
-                     - ColorMapper.COLORS[None,None,...])
+        # (N x 1) + (1 x p) -> (N x p)
+        mean_r = (rgb[..., None, 0]
+                  + colors[None, :, 0]) / 220
+        # delta_rgb: difference between each color and each palette color
+        # (N x 1 x 3) - (1 x p x 3) -> (N x p x 3)
+        delta_rgb = (rgb[..., None, :3]
+                     - colors[None, ...])
         # weights: [2 + r_mean/256, 4, 2 + (255 - r_mean)/256]
-        # (m x n x p x 3)
+        # (N x p x 3)
         weights = np.empty_like(delta_rgb)
-        weights[...,0] = 2 + mean_r/256
-        weights[...,1] = 4
-        weights[...,2] = 3 - mean_r/256
-        # delta_c: weighted distance between each pixel and each palette color
-        # (m x n x p x 3) * (m x n x p x 3) -> (m x n x p)
+        weights[..., 0] = 2 + mean_r / 256
+        weights[..., 1] = 4
+        weights[..., 2] = 3 - mean_r / 256
+        # delta_c: weighted distance between each color and each palette color
+        # (N x p x 3) * (N x p x 3) -> (N x p)
         delta_c = np.einsum('...i,...i->...', weights, delta_rgb**2)
-        # new_rgb_id: palette color id with minimum distance to the corresponding pixel
-        # (m x n x p) -> (m x n)
-        corrected_color_ids = np.argmin(delta_c, axis=-1)
-        corrected_image[...,:3] = ColorMapper.COLORS[corrected_color_ids]
-        return corrected_image.astype(np.uint8)
+        return delta_c
+
+    @staticmethod
+    def _euclidean_distances(rgb: np.ndarray, colors: np.ndarray) -> np.ndarray:
+        """Squared sRGB distance between colors (N x 3) and the palette colors (N x p)."""
+        delta_rgb = (rgb[..., None, :3].astype(np.int32)
+                     - colors[None, ...])
+        return np.einsum('...i,...i->...', delta_rgb, delta_rgb)
+
+    @staticmethod
+    def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+        """Convert sRGB values (... x 3) to CIELAB (... x 3), D65 white point."""
+        # sRGB -> linear rgb
+        linear = np.asarray(rgb, dtype=np.float64) / 255
+        linear = np.where(
+            linear <= 0.04045, linear / 12.92, ((linear + 0.055) / 1.055) ** 2.4
+        )
+        # linear rgb -> XYZ relative to the white point
+        xyz = linear @ ColorMapper._RGB_TO_XYZ.T / ColorMapper._WHITE
+        # XYZ -> Lab
+        f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+        return np.stack([
+            116 * f[..., 1] - 16,
+            500 * (f[..., 0] - f[..., 1]),
+            200 * (f[..., 1] - f[..., 2]),
+        ], axis=-1)
+
+    @staticmethod
+    def _cie76_distances(rgb: np.ndarray, colors: np.ndarray) -> np.ndarray:
+        """Squared CIE76 difference between colors (N x 3) and the palette colors (N x p)."""
+        delta_lab = (ColorMapper.rgb_to_lab(rgb[..., :3])[..., None, :]
+                     - ColorMapper.rgb_to_lab(colors)[None, ...])
+        return np.einsum('...i,...i->...', delta_lab, delta_lab)
+
+    @staticmethod
+    def _ciede2000_distances(rgb: np.ndarray, colors: np.ndarray) -> np.ndarray:
+        """
+        CIEDE2000 difference between colors (N x 3) and the palette colors (N x p)
+
+        https://en.wikipedia.org/wiki/Color_difference#CIEDE2000
+        with kL = kC = kH = 1.
+        """
+        # (N x 1) and (1 x p) channels, broadcast to (N x p)
+        lab1 = ColorMapper.rgb_to_lab(rgb[..., :3])[:, None, :]
+        lab2 = ColorMapper.rgb_to_lab(colors)[None, ...]
+        l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+        l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+        # a' corrected for the chroma of both colors
+        c_mean = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+        g = 0.5 * (1 - np.sqrt(c_mean**7 / (c_mean**7 + 25.0**7)))
+        a1 = a1 * (1 + g)
+        a2 = a2 * (1 + g)
+        c1 = np.hypot(a1, b1)
+        c2 = np.hypot(a2, b2)
+        h1 = np.degrees(np.arctan2(b1, a1)) % 360
+        h2 = np.degrees(np.arctan2(b2, a2)) % 360
+
+        # Differences of lightness, chroma and hue
+        delta_l = l2 - l1
+        delta_c = c2 - c1
+        delta_h = h2 - h1
+        delta_h = np.where(delta_h > 180, delta_h - 360, delta_h)
+        delta_h = np.where(delta_h < -180, delta_h + 360, delta_h)
+        # hue difference is undefined for achromatic colors
+        chromatic = (c1 * c2) != 0
+        delta_h = np.where(chromatic, delta_h, 0)
+        delta_hue = 2 * np.sqrt(c1 * c2) * np.sin(np.radians(delta_h / 2))
+
+        # Means of lightness, chroma and hue
+        l_mean = (l1 + l2) / 2
+        c_mean = (c1 + c2) / 2
+        h_mean = h1 + h2
+        h_mean = np.where(
+            np.abs(h1 - h2) > 180,
+            np.where(h_mean < 360, h_mean + 360, h_mean - 360),
+            h_mean,
+        ) / 2
+        h_mean = np.where(chromatic, h_mean, h1 + h2)
+
+        # Weighting functions
+        t = (1
+             - 0.17 * np.cos(np.radians(h_mean - 30))
+             + 0.24 * np.cos(np.radians(2 * h_mean))
+             + 0.32 * np.cos(np.radians(3 * h_mean + 6))
+             - 0.20 * np.cos(np.radians(4 * h_mean - 63)))
+        s_l = 1 + 0.015 * (l_mean - 50)**2 / np.sqrt(20 + (l_mean - 50)**2)
+        s_c = 1 + 0.045 * c_mean
+        s_h = 1 + 0.015 * c_mean * t
+        r_t = (-2 * np.sqrt(c_mean**7 / (c_mean**7 + 25.0**7))
+               * np.sin(np.radians(60 * np.exp(-(((h_mean - 275) / 25)**2)))))
+
+        return np.sqrt(
+            (delta_l / s_l)**2
+            + (delta_c / s_c)**2
+            + (delta_hue / s_h)**2
+            + r_t * (delta_c / s_c) * (delta_hue / s_h)
+        )
+
+    @staticmethod
+    def palette_key(colors: np.ndarray = None) -> str:
+        """Key identifying colors (COLORS if None) and METRIC, i.e. the result of correct_image."""
+        if colors is None:
+            colors = ColorMapper.COLORS
+        return hashlib.sha1(
+            colors.tobytes() + ColorMapper.METRIC.encode()
+        ).hexdigest()[:16]
+
+    @staticmethod
+    def lookup_table(colors: np.ndarray = None) -> np.ndarray:
+        """
+        Lookup table of the closest color of colors (COLORS if None) of every packed rgb value
+
+        One table of 2^24 palette positions per palette and METRIC, switched
+        automatically with them. Entries are computed the first time they are looked up,
+        UNSET until then. When LUT_DIR is set, tables are cached there and
+        memory-mapped, so they are only computed once across restarts.
+        """
+        key = ColorMapper.palette_key(colors)
+        lut = ColorMapper._LUTS.get(key)
+        if lut is not None:
+            return lut
+
+        if ColorMapper.LUT_DIR:
+            os.makedirs(ColorMapper.LUT_DIR, exist_ok=True)
+            path = os.path.join(ColorMapper.LUT_DIR, f"lut_{key}.npy")
+            if not os.path.exists(path):
+                # Filled in a temporary file first, a crash must not leave a
+                # table of zeros behind
+                fd, temp_path = tempfile.mkstemp(dir=ColorMapper.LUT_DIR, suffix=".npy")
+                os.close(fd)
+                try:
+                    table = np.lib.format.open_memmap(
+                        temp_path, mode="w+", dtype=np.uint8, shape=(1 << 24,)
+                    )
+                    table[:] = ColorMapper._UNSET
+                    table.flush()
+                    del table
+                    os.replace(temp_path, path)
+                except OSError:
+                    os.remove(temp_path)
+                    raise
+            lut = np.load(path, mmap_mode="r+")
+        else:
+            lut = np.full(1 << 24, ColorMapper._UNSET, dtype=np.uint8)
+        ColorMapper._LUTS[key] = lut
+        return lut
+
+    @staticmethod
+    def closest_positions(rgb: np.ndarray, colors: np.ndarray = None) -> np.ndarray:
+        """Position in colors (COLORS if None) of the closest color of rgb values (... x 3)."""
+        if colors is None:
+            colors = ColorMapper.COLORS
+        lut = ColorMapper.lookup_table(colors)
+        packed = ColorMapper.pack_rgb(rgb)
+        positions = lut[packed]
+
+        # Compute the colors never looked up before
+        missing = positions == ColorMapper._UNSET
+        if missing.any():
+            packed = packed[missing]
+            unique = np.unique(packed)
+            lut[unique] = ColorMapper.closest_colors(
+                ColorMapper.unpack_rgb(unique), colors
+            )
+            if isinstance(lut, np.memmap):
+                lut.flush()
+            positions[missing] = lut[packed]
+        return positions
+
+    @staticmethod
+    def correct_image(target_image: np.ndarray, colors: np.ndarray = None) -> np.ndarray:
+        """
+        Replace the rgb channels of an image (m x n x 3 or 4) by the closest palette colors
+
+        Colors are looked up in lookup_table, see closest_colors for the metric.
+        The image is corrected in place, by bands of rows within MEMORY_BUDGET.
+        The palette is colors, or COLORS when called, even if it is updated meanwhile.
+        """
+        if colors is None:
+            colors = ColorMapper.COLORS
+
+        corrected_image = target_image
+        # Rows corrected at once, keeping the temporaries within MEMORY_BUDGET
+        row_size = max(
+            int(np.prod(target_image.shape[1:-1])) * ColorMapper._PIXEL_BYTES, 1
+        )
+        band = max(ColorMapper.MEMORY_BUDGET // row_size, 1)
+        for top in range(0, target_image.shape[0], band):
+            rows = corrected_image[top:top + band]
+            rows[..., :3] = colors[ColorMapper.closest_positions(rows[..., :3], colors)]
+        return corrected_image.astype(np.uint8, copy=False)
@@ -0,0 +1,332 @@
+import threading
+import time
+
+import numpy as np
+
+from src.mappings import ColorMapper
+
+
+class PixelSet:
+    """
+    Set of flat pixel indices in [0, size)
+
+    A boolean mask answers membership, the members are packed at the front of
+    a flat index array and every pixel knows its position in it. Adding,
+    removing, counting and drawing a random member are O(1) per pixel, and the
+    bulk operations are vectorized, without any per-pixel Python object.
+    """
+
+    def __init__(self, size: int):
+        self.mask = np.zeros(size, dtype=bool)
+        self.members = np.empty(size, dtype=np.int32)
+        self.positions = np.full(size, -1, dtype=np.int32)
+        self.count = 0
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray, **kwargs) -> "PixelSet":
+        """Set of the flat indices where mask is set."""
+        pixel_set = cls(mask.size, **kwargs)
+        pixel_set.add(np.flatnonzero(mask))
+        return pixel_set
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, index):
+        return bool(self.mask[index])
+
+    def add(self, indices: np.ndarray) -> np.ndarray:
+        """Add the given pixels, returns the ones that were not present."""
+        indices = np.unique(indices)
+        indices = indices[~self.mask[indices]]
+        end = self.count + len(indices)
+        self.mask[indices] = True
+        self.members[self.count : end] = indices
+        self.positions[indices] = np.arange(self.count, end)
+        self.count = end
+        return indices
+
+    def discard(self, indices: np.ndarray):
+        """Remove the given pixels, missing ones are ignored."""
+        indices = np.unique(indices)
+        indices = indices[self.mask[indices]]
+        end = self.count - len(indices)
+        self.mask[indices] = False
+
+        # Move the members left after the new end into the holes before it
+        holes = self.positions[indices]
+        holes = holes[holes < end]
+        tail = self.members[end : self.count]
+        tail = tail[self.mask[tail]]
+        self.members[holes] = tail
+        self.positions[tail] = holes
+
+        self.positions[indices] = -1
+        self.count = end
+
+    def update(self, indices: np.ndarray, values: np.ndarray):
+        """Set the membership of each pixel of indices to the matching value."""
+        self.discard(indices[~values])
+        self.add(indices[values])
+
+    def sample(self) -> int:
+        """Random member, None if empty."""
+        if self.count == 0:
+            return None
+        return int(self.members[np.random.randint(self.count)])
+
+    def pop(self) -> int:
+        """Remove and return a random member, None if empty."""
+        index = self.sample()
+        if index is not None:
+            self.discard(np.array([index]))
+        return index
+
+
+class PixelQueue(PixelSet):
+    """
+    PixelSet handing out its members by priority
+
+    Every pixel has a static priority, replaced in bulk with prioritize. When
+    popping, the minutes since a pixel became wrong weighted by age_weight, and
+    a random value in [0, 1) weighted by random_weight, are added to it and the
+    member with the highest score is returned. A pixel removed without being
+    found correct by update, e.g. popped, keeps its age when added back.
+    """
+
+    def __init__(self, size: int, age_weight=0.0, random_weight=1.0):
+        super().__init__(size)
+        self.priorities = np.zeros(size, dtype=np.float32)
+        # time each pixel became wrong, NaN if not wrong
+        self.since = np.full(size, np.nan, dtype=np.float64)
+        self.age_weight = age_weight
+        self.random_weight = random_weight
+
+    def add(self, indices: np.ndarray) -> np.ndarray:
+        indices = super().add(indices)
+        fresh = indices[np.isnan(self.since[indices])]
+        self.since[fresh] = time.time()
+        return indices
+
+    def update(self, indices: np.ndarray, values: np.ndarray):
+        # pixels found correct start a new age when wrong again
+        self.since[indices[~values]] = np.nan
+        super().update(indices, values)
+
+    def prioritize(self, priorities: np.ndarray):
+        """Replace the static priority of every pixel."""
+        self.priorities = priorities.astype(np.float32).ravel()
+
+    def scores(self) -> np.ndarray:
+        """Score of every member, in the order of members."""
+        members = self.members[: self.count]
+        scores = self.priorities[members].astype(np.float64)
+        if self.age_weight:
+            scores += self.age_weight * (time.time() - self.since[members]) / 60
+        if self.random_weight:
+            scores += self.random_weight * np.random.random(self.count)
+        return scores
+
+    def sample(self) -> int:
+        """Member with the highest score, None if empty."""
+        if self.count == 0:
+            return None
+        return int(self.members[np.argmax(self.scores())])
+
+
+class Reservations:
+    """
+    Pixels handed out and waiting on their placement, by canvas position (x, y)
+
+    A reservation expires ttl seconds after it was made, in case its placement
+    result never comes.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.expirations = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, coord):
+        with self.lock:
+            self.expirations[tuple(map(int, coord))] = time.monotonic() + self.ttl
+
+    def release(self, coord):
+        with self.lock:
+            self.expirations.pop(tuple(map(int, coord)), None)
+
+    def __contains__(self, coord):
+        expiration = self.expirations.get(tuple(map(int, coord)))
+        return expiration is not None and expiration > time.monotonic()
+
+    def active(self) -> list:
+        """Positions of the pixels still reserved."""
+        now = time.monotonic()
+        with self.lock:
+            return [
+                coord
+                for coord, expiration in self.expirations.items()
+                if expiration > now
+            ]
+
+    def purge(self) -> list:
+        """Drop the expired reservations, returns their positions."""
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                coord
+                for coord, expiration in self.expirations.items()
+                if expiration <= now
+            ]
+            for coord in expired:
+                del self.expirations[coord]
+            return expired
+
+
+class TemplateIndex:
+    """
+    Sparse index of the opaque pixels of a template
+
+    Every opaque pixel of the template (color ids, INVALID_ID where transparent)
+    gets a position in the index, holding its row, column, color id and the
+    label of the source template it comes from, if labels are given. The
+    positions are also bucketed by square tiles, to find the ones in an area
+    without scanning it.
+    """
+
+    def __init__(self, template: np.ndarray, labels: np.ndarray = None, tile_size=64):
+        self.shape = template.shape
+        self.flat = np.flatnonzero(template != ColorMapper.INVALID_ID)
+        rows, columns = np.divmod(self.flat, self.shape[1])
+        self.rows = rows.astype(np.int32)
+        self.columns = columns.astype(np.int32)
+        self.color_ids = template.ravel()[self.flat]
+        if labels is None:
+            labels = np.zeros(self.shape, dtype=np.uint16)
+        self.labels = labels.ravel()[self.flat]
+        self.label_totals = np.bincount(
+            self.labels, minlength=labels.max(initial=0) + 1
+        )
+
+        # Positions sorted by tile, the ones of tile t are
+        # tile_order[tile_starts[t] : tile_starts[t + 1]]
+        self.tile_size = tile_size
+        self.tile_columns = -(-self.shape[1] // tile_size)
+        tile_rows = -(-self.shape[0] // tile_size)
+        tiles = self._tile(self.rows, self.columns)
+        self.tile_order = np.argsort(tiles, kind="stable").astype(np.int32)
+        self.tile_starts = np.searchsorted(
+            tiles[self.tile_order], np.arange(tile_rows * self.tile_columns + 1)
+        )
+
+    def __len__(self):
+        return len(self.flat)
+
+    def _tile(self, rows, columns):
+        return (rows // self.tile_size) * self.tile_columns + columns // self.tile_size
+
+    def wrong(self, board: np.ndarray, positions: np.ndarray = None) -> np.ndarray:
+        """
+        Whether board differs from the template at positions, all if None
+
+        board is aligned with the template, pixels outside of it (past the
+        edge of the canvas) are never wrong.
+        """
+        if positions is None:
+            positions = np.arange(len(self))
+        rows = self.rows[positions]
+        columns = self.columns[positions]
+        if board.shape == self.shape:
+            return board[rows, columns] != self.color_ids[positions]
+        inside = (rows < board.shape[0]) & (columns < board.shape[1])
+        wrong = np.zeros(len(positions), dtype=bool)
+        wrong[inside] = (
+            board[rows[inside], columns[inside]] != self.color_ids[positions][inside]
+        )
+        return wrong
+
+    def label_counts(self, positions: np.ndarray, minlength=0) -> np.ndarray:
+        """Number of positions with each label, indexed by label."""
+        return np.bincount(
+            self.labels[positions], minlength=max(minlength, len(self.label_totals))
+        )
+
+    def gather(self, values: np.ndarray) -> np.ndarray:
+        """Values of a template sized array at every position."""
+        return values[self.rows, self.columns]
+
+    def find(self, rows, columns) -> np.ndarray:
+        """Positions of the pixels (rows, columns), -1 if transparent or outside."""
+        rows = np.asarray(rows)
+        columns = np.asarray(columns)
+        inside = (
+            (rows >= 0)
+            & (rows < self.shape[0])
+            & (columns >= 0)
+            & (columns < self.shape[1])
+        )
+        flat = np.where(inside, rows * self.shape[1] + columns, -1)
+        positions = np.searchsorted(self.flat, flat).clip(max=max(len(self) - 1, 0))
+        found = inside & (len(self) > 0)
+        found[found] = self.flat[positions[found]] == flat[found]
+        return np.where(found, positions, -1)
+
+    def in_area(self, rows: slice, columns: slice) -> np.ndarray:
+        """Positions of the pixels inside the area (rows, columns)."""
+        top, bottom = rows.start or 0, min(rows.stop, self.shape[0])
+        left, right = columns.start or 0, min(columns.stop, self.shape[1])
+        if top >= bottom or left >= right:
+            return np.empty(0, dtype=np.int32)
+        tile_size = self.tile_size
+        tiles = (
+            np.arange(top // tile_size, -(-bottom // tile_size))[:, None]
+            * self.tile_columns
+            + np.arange(left // tile_size, -(-right // tile_size))
+        ).ravel()
+        positions = np.concatenate(
+            [
+                self.tile_order[self.tile_starts[t] : self.tile_starts[t + 1]]
+                for t in tiles
+            ]
+        )
+        # the tiles may stick out of the area
+        inside = (
+            (self.rows[positions] >= top)
+            & (self.rows[positions] < bottom)
+            & (self.columns[positions] >= left)
+            & (self.columns[positions] < right)
+        )
+        return positions[inside]
+
+
+def edge_closeness(mask: np.ndarray, limit: int) -> np.ndarray:
+    """
+    Closeness of every pixel of mask to the edge of mask
+
+    1 on the edge, decreasing linearly with the number of pixels to the
+    closest pixel outside of mask, 0 from limit pixels away and outside mask.
+    """
+    distance = np.zeros(mask.shape, dtype=np.float32)
+    inside = mask.copy()
+    for _ in range(limit):
+        if not inside.any():
+            break
+        distance += inside
+        # erode by one pixel, outside of the array counts as outside of mask
+        padded = np.pad(inside, 1)
+        inside &= padded[:-2, 1:-1] & padded[2:, 1:-1]
+        inside &= padded[1:-1, :-2] & padded[1:-1, 2:]
+    closeness = (limit - distance) / max(limit - 1, 1)
+    closeness[~mask] = 0
+    return closeness.clip(0, 1)
+
+
+def point_closeness(shape: tuple, point) -> np.ndarray:
+    """
+    Closeness of every pixel of an array of shape to point (x, y)
+
+    1 on point, decreasing linearly to 0 at the length of the array diagonal.
+    """
+    ys, xs = np.indices(shape, dtype=np.float32)
+    distance = np.hypot(xs - point[0], ys - point[1])
+    return (1 - distance / np.hypot(*shape)).clip(0, 1)
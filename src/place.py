@@ -1,6 +1,7 @@
 import numpy as np
 import time
 import threading
+from collections import deque
 from loguru import logger
 from json import JSONDecodeError
 
@@ -8,6 +9,20 @@ from src.mappings import ColorMapper
 import src.proxy as proxy
 import src.utils as utils
 import src.connect as connect
+import src.tokens as tokens
+from src.board import BoardSubscriber
+from src.pixels import (
+    PixelQueue, Reservations, TemplateIndex, edge_closeness, point_closeness
+)
+
+# Weights of the pixel priorities, overridden by "priority_weights" in config
+DEFAULT_PRIORITY_WEIGHTS = {
+    "template": 1.0,  # priority of the source template from "template_priorities"
+    "edge": 0.0,  # closeness to the edges of the template
+    "focus": 0.0,  # closeness to "focus_point"
+    "age": 0.0,  # per minute the pixel has been wrong
+    "random": 1.0,  # random value in [0, 1)
+}
 
 
 class PlaceClient:
@@ -22,6 +37,10 @@ class PlaceClient:
         self.stop_event = threading.Event()
         self.board_outdated = threading.Event()
         self.template_outdated = threading.Event()
+        # Signalled on board, template, assignments and stop changes
+        self.changed = threading.Condition()
+        # Wrong pixel handed out by the dispatcher to the workers
+        self.assignments = deque()
 
         # Data
         self.config_path = config_path
@@ -29,6 +48,9 @@ class PlaceClient:
         self.config = utils.get_json_data(self, self.config_path)
         self.canvas = utils.get_json_data(self, self.canvas_path)
 
+        # Pixels being placed, not handed out again until released or expired
+        self.reservations = Reservations(self.config_get("reservation_ttl", 60))
+
         proxy.Init(self)
 
         self.colors_count = 0
@@ -37,61 +59,199 @@ class PlaceClient:
         self.access_tokens = {}
         self.access_token_expires_at_timestamp = {}
 
+        # Color lookup tables are kept on disk if configured
+        ColorMapper.LUT_DIR = self.config_get("color_lut_dir")
+        # Bound the memory used to correct large templates
+        ColorMapper.MEMORY_BUDGET = self.config_get("color_memory_budget", 256) << 20
+        ColorMapper.THREADS = self.config_get("color_threads", 1)
+        ColorMapper.METRIC = self.config_get("color_metric", "redmean")
+
+        # Palette quantized templates, by content and palette
+        self.quantized_templates = {}
+        # Templates last saved to "image_path"
+        self.template_key = None
+
         # Load template
         data = utils.load_template_data(self)
         if not data:
             exit(1)  # exit if template is empty
-        coord, template = data
+        coord, template, labels, names = data
 
         # Template information
         self.coord = coord + np.array(self.canvas['offset']['template_api'])
         self.size = np.array(template.size)
-        self.template = ColorMapper.correct_image(np.array(template))
+        # source template of each pixel, position in template_names + 1, 0 if none
+        self.template_labels = labels
+        self.template_names = names
+        # color ids, INVALID_ID where transparent
+        self.template = ColorMapper.image_to_ids(np.array(template))
+        # opaque pixels of the template
+        self.template_index = TemplateIndex(self.template, labels)
+        # correct, wrong and total pixels by source template name
+        self.template_stats = {}
 
         # Board information
+        self.board_subscriber = BoardSubscriber(
+            self, on_change=lambda: self.signal(self.board_outdated)
+        )
+        self.board_subscriber.set_region(self.coord, self.size)
         self.board: np.ndarray = None
-        self.wrong_pixels: list = []
+        # Positions in template_index of the wrong pixels,
+        # None when they have to be computed from scratch
+        self.wrong_pixels: PixelQueue = None
+        self.priority_weights: dict = None
 
     # Update board, templates and canvas offsets
     # Returns position, size and template image
     def _update(self, username):
-        # Update board image if outdated
-        if self.board_outdated.is_set() or self.board is None:
-            self.board_outdated.clear()
-            logger.debug("Thread {}: Updating board image", username)
-            self.board = np.array(
-                connect
-                .get_board(self, self.access_tokens[username])
-                .crop((*self.coord, self.coord[0] + self.size[0], self.coord[1] + self.size[1]))
-                .convert("RGB")
-            )
-            # Compute wrong pixels (cropped template relative position)
-            coords = np.argwhere(
-                (self.template[...,3] == 255)
-                & (self.template[...,:3] != self.board).any(axis=-1)
-            )
-            np.random.shuffle(coords)
-            # get rgb values of wrong pixels
-            target_rgb = self.template[coords[:,0], coords[:,1]][:,:3]
-            self.wrong_pixels = list(zip(coords, target_rgb))
-            logger.info("Thread {}: Board image updated", username)
-
         # Update template image and canvas offsets if outdated
         if self.template_outdated.is_set():
             self.template_outdated.clear()
             logger.debug("Thread {}: Updating template image and canvas offsets", username)
+            template_key = self.template_key
             data = utils.load_template_data(self)
             if not data:
                 return  # skip updating
-            coord, template = data
+            coord, template, labels, names = data
             self.canvas = utils.get_json_data(self, self.canvas_path)
-            self.coord = coord + np.array(self.canvas['offset']['template_api'])
-            self.size = np.array(template.size)
-            template = np.array(template)
-            # rgb channels converted to nearest colorpalette color
-            self.template = ColorMapper.correct_image(template)
-            logger.info("Thread {}: Template image and canvas offsets updated", username)
-        
+            coord = coord + np.array(self.canvas['offset']['template_api'])
+            if self.template_key == template_key and np.array_equal(coord, self.coord):
+                # Keep the wrong pixels and their age
+                logger.info("Thread {}: Template image and canvas offsets unchanged", username)
+            else:
+                self.coord = coord
+                self.size = np.array(template.size)
+                self.template_labels = labels
+                self.template_names = names
+                self.board_subscriber.set_region(self.coord, self.size)
+                # template colors are already palette colors
+                self.template = ColorMapper.image_to_ids(np.array(template))
+                self.template_index = TemplateIndex(self.template, labels)
+                self.wrong_pixels = None
+                logger.info("Thread {}: Template image and canvas offsets updated", username)
+
+        # Update board image if outdated
+        if self.board_outdated.is_set() or self.wrong_pixels is None:
+            self.board_outdated.clear()
+            logger.debug("Thread {}: Updating board image", username)
+            # Board is kept up to date by the subscription, no request needed
+            self.board_subscriber.start(username)
+            if not self.board_subscriber.wait_ready():
+                return
+            # Pixels whose placement result never came are compared again
+            for coord in self.reservations.purge():
+                self.board_subscriber.touch(coord)
+            box = (*self.coord, self.coord[0] + self.size[0], self.coord[1] + self.size[1])
+            # live view of the board, no copy
+            self.board = self.board_subscriber.view(box)
+            dirty = self.board_subscriber.take_dirty(box)
+            weights = self._priority_weights()
+            # None when computed from scratch
+            wrong_count = None if self.wrong_pixels is None else len(self.wrong_pixels)
+            if self.wrong_pixels is None:
+                # Compute wrong pixels of the whole template
+                self.wrong_pixels = PixelQueue.from_mask(
+                    self.template_index.wrong(self.board),
+                    age_weight=weights["age"], random_weight=weights["random"]
+                )
+                self.wrong_pixels.prioritize(self._pixel_priorities(weights))
+            else:
+                if weights != self.priority_weights:
+                    logger.debug("Thread {}: Updating pixel priorities", username)
+                    self.wrong_pixels.age_weight = weights["age"]
+                    self.wrong_pixels.random_weight = weights["random"]
+                    self.wrong_pixels.prioritize(self._pixel_priorities(weights))
+                # Only compare again the opaque pixels of the tiles changed
+                # since the last update
+                if dirty:
+                    positions = np.concatenate([
+                        self.template_index.in_area(rows, columns)
+                        for rows, columns in dirty
+                    ])
+                    self.wrong_pixels.update(
+                        positions, self.template_index.wrong(self.board, positions)
+                    )
+            self.priority_weights = weights
+            # Pixels being placed may still look wrong on the board
+            reserved = self.reservations.active()
+            if reserved:
+                columns, rows = (np.array(reserved) - self.coord).T
+                positions = self.template_index.find(rows, columns)
+                self.wrong_pixels.discard(positions[positions >= 0])
+            self._update_template_stats()
+            # Updated after every frame, only worth telling when the count changed
+            logger.log(
+                "INFO" if len(self.wrong_pixels) != wrong_count else "DEBUG",
+                "Thread {}: Board image updated, {} of {} pixels wrong in {} changed tiles",
+                username, len(self.wrong_pixels), len(self.template_index), len(dirty)
+            )
+
+    # Count the correct and wrong pixels of every source template
+    # Pixels being placed count as correct
+    def _update_template_stats(self):
+        index = self.template_index
+        # templates hidden by others may have no pixel left
+        count = len(self.template_names) + 1
+        totals = np.zeros(count, dtype=np.int64)
+        totals[:len(index.label_totals)] = index.label_totals
+        wrong = index.label_counts(
+            self.wrong_pixels.members[:len(self.wrong_pixels)], count
+        )
+        self.template_stats = {
+            name: {
+                "correct": int(totals[label] - wrong[label]),
+                "wrong": int(wrong[label]),
+                "total": int(totals[label]),
+            }
+            for label, name in enumerate(self.template_names, 1)
+        }
+
+    # Correct, wrong and total pixels of every source template, by name
+    def get_template_stats(self):
+        return dict(self.template_stats)
+
+    def log_template_stats(self):
+        for name, stats in self.get_template_stats().items():
+            logger.info(
+                "Template {}: {}/{} pixels correct ({:.1f}%), {} wrong",
+                name, stats["correct"], stats["total"],
+                100 * stats["correct"] / max(stats["total"], 1), stats["wrong"]
+            )
+
+    # Configured pixel priority weights
+    def _priority_weights(self):
+        return {
+            **DEFAULT_PRIORITY_WEIGHTS,
+            **self.config_get("priority_weights", {}),
+            "focus_point": self.config_get("focus_point"),
+            "edge_distance": self.config_get("edge_distance", 16),
+            "template_priorities": self.config_get("template_priorities", {}),
+        }
+
+    # Static priority of every opaque template pixel, by template_index position
+    def _pixel_priorities(self, weights):
+        index = self.template_index
+        # priority of the source template, by label
+        template_priorities = np.array([0] + [
+            weights["template_priorities"].get(name, 0) for name in self.template_names
+        ], dtype=np.float32)
+        priorities = weights["template"] * template_priorities[index.labels]
+        if weights["edge"]:
+            priorities += weights["edge"] * index.gather(edge_closeness(
+                self.template != ColorMapper.INVALID_ID, weights["edge_distance"]
+            ))
+        if weights["focus"] and weights["focus_point"]:
+            # visual position -> cropped template relative position
+            point = (
+                np.array(weights["focus_point"])
+                - np.array(self.canvas['offset']['visual'])
+                - self.coord
+            )
+            priorities += weights["focus"] * index.gather(
+                point_closeness(self.template.shape, point)
+            )
+        return priorities
+
     # Thread-safe config getter
     def config_get(self, key, default=None):
         with self.config_lock:
@@ -102,46 +262,119 @@ class PlaceClient:
         with self.config_lock:
             self.config = utils.get_json_data(self, self.config_path)
 
-    def get_wrong_pixel(self, username):
-        # Check every 10 seconds for an unset pixel
-        while not self.stop_event.wait(timeout=10):
-            # Threads should have exclusive access to updating data
-            with self.update_lock:
-                # Update information
-                self._update(username)
-
-                # Pop the first unset pixel
-                if len(self.wrong_pixels) > 0:
-                    coord, rgb = self.wrong_pixels.pop()
-                    logger.info(
-                        "Thread {}: Found unset pixel at {}",  # shows visual position
-                        username, coord + self.coord + np.array(self.canvas['offset']['visual'])
+    # Release a pixel handed out, it is compared again with the board and
+    # added back to the wrong pixels if it is still wrong
+    def release_pixel(self, coord):
+        self.reservations.release(coord)
+        self.board_subscriber.touch(coord)
+        self.signal(self.board_outdated)
+
+    # Set event, if any, and wake up every thread waiting for a change
+    def signal(self, event=None):
+        with self.changed:
+            if event is not None:
+                event.set()
+            self.changed.notify_all()
+
+    # Refresh board and template, and hand out wrong pixels to the workers
+    def dispatch(self):
+        # The board subscription uses the access token of a worker
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.access_tokens or self.stop_event.is_set()
+            )
+
+        while not self.stop_event.is_set():
+            try:
+                username = list(self.access_tokens)[0]
+                # Threads should have exclusive access to updating data
+                with self.update_lock:
+                    # Update information
+                    self._update(username)
+
+                with self.changed:
+                    # Hand out the unset pixel with the highest priority
+                    if (not self.assignments and self.wrong_pixels is not None
+                            and len(self.wrong_pixels) > 0):
+                        position = self.wrong_pixels.pop()
+                        index = self.template_index
+                        # canvas position (x, y) and color id
+                        coord = self.coord + np.array(
+                            [index.columns[position], index.rows[position]]
+                        )
+                        self.reservations.reserve(coord)
+                        self.assignments.append((coord, index.color_ids[position]))
+                        self.changed.notify_all()
+                    elif not self.assignments:
+                        logger.info("Dispatcher: All pixels are correct, waiting for changes...")
+
+                    # Sleep until something needs to be refreshed or handed out
+                    self.changed.wait_for(
+                        lambda: self.stop_event.is_set()
+                        or self.board_outdated.is_set()
+                        or self.template_outdated.is_set()
+                        or (
+                            not self.assignments
+                            and self.wrong_pixels is not None
+                            and len(self.wrong_pixels) > 0
+                        )
                     )
-                    return coord, rgb
-            
-            # All pixels correct, try again in 10 seconds
+            except Exception:
+                # Keep refreshing, the workers depend on the dispatcher
+                logger.exception("Dispatcher: Failed to update, retrying")
+                self.stop_event.wait(self.config_get("thread_delay") or 3)
+
+    def get_wrong_pixel(self, username):
+        while True:
+            with self.changed:
+                self.changed.wait_for(
+                    lambda: self.assignments or self.stop_event.is_set()
+                )
+                if self.stop_event.is_set():
+                    return None
+                coord, color_id = self.assignments.popleft()
+                # Let the dispatcher prepare the next one
+                self.changed.notify_all()
+
+            # The reservation expired while waiting, the pixel is compared
+            # again with the board and may be handed out anew
+            if coord not in self.reservations:
+                continue
+            # The pixel may have been set since it was handed out
+            if self.board_subscriber.color_at(coord) == color_id:
+                self.reservations.release(coord)
+                continue
+            # The assignment may have waited for a while, start the ttl again
+            self.reservations.reserve(coord)
             logger.info(
-                "Thread {}: All pixels are correct, trying again in 10 seconds...",
-                username
+                "Thread {}: Found unset pixel at {}",  # shows visual position
+                username, coord + np.array(self.canvas['offset']['visual'])
             )
+            return coord, color_id
 
     def set_pixel_and_check_ratelimit(self, color_index, coord, username,
-                                      new_rgb, target_rgb, board_rgb):
+                                      board_color_index):
 
         with self.print_lock:
             logger.opt(colors=True).warning(
                 "Thread {}: Attempting to place pixel",
                 username
             )
+            new_rgb = ColorMapper.ids_to_rgb(color_index)
             new_rgb_name = ColorMapper.color_id_to_name(color_index)
-            board_rgb_name = ColorMapper.rgb_to_name(board_rgb)
+            board_rgb = ColorMapper.ids_to_rgb(board_color_index)
+            board_rgb_name = ColorMapper.color_id_to_name(board_color_index)
             print(f"Thread {username}",  # shows visual position
                   f"Pixel position: {coord + np.array(self.canvas['offset']['visual'])}",
-                  f"Template color: [\033[38;2;{';'.join(map(str, target_rgb))}m▉\033[0m]",
                   f"Expected color: [\033[38;2;{';'.join(map(str, new_rgb))}m▉\033[0m] ({new_rgb_name})",
                   f"Board    color: [\033[38;2;{';'.join(map(str, board_rgb))}m▉\033[0m] ({board_rgb_name})",
                   sep='\n')
 
+        # Watch the board for the pixel, registered before placing it to not
+        # miss the update
+        canvas_coord = coord
+        placed = self.board_subscriber.expect(canvas_coord, color_index)
+
         # Convert global pixel position to local pixel position (Reddit API)
         # canvas structure:
         # 0 | 1 | 2
@@ -150,9 +383,17 @@ class PlaceClient:
         coord = coord % 1000
 
         response = connect.set_pixel(self, coord, color_index,
-                                     subcanvas, self.access_tokens[username])
+                                     subcanvas, self.access_tokens[username],
+                                     username)
         logger.debug("Thread {}: Received response: {}", username, response.text)
 
+        # Access token rejected, log in again
+        if response.status_code in (401, 403):
+            self.board_subscriber.forget(canvas_coord)
+            logger.warning("Thread {}: Access token rejected", username)
+            tokens.forget_access_token(self, username)
+            return time.time()
+
         # Successfully placed
         if response.json()["data"] is not None:
             
@@ -161,6 +402,12 @@ class PlaceClient:
                 ["data"]["nextAvailablePixelTimestamp"]
             ) / 1000
 
+            # Confirmed once the board shows the pixel
+            if placed.wait(self.config_get("placement_timeout", 10)):
+                logger.success("Thread {}: Succeeded placing pixel", username)
+                return next_time
+            self.board_subscriber.forget(canvas_coord)
+
             #Check if pixel was placed, potential shadowban
             who_placed = connect.check(self, coord, color_index, subcanvas, username) 
             if who_placed == username:
@@ -171,6 +418,7 @@ class PlaceClient:
                 return time.time()
             return next_time
         
+        self.board_subscriber.forget(canvas_coord)
         logger.debug(response.json().get("errors"))
         errors = response.json().get("errors")[0]
 
@@ -195,6 +443,11 @@ class PlaceClient:
             # get the current time
             current_time = time.time()
 
+            # Use the access token stored by a previous run, if still valid
+            if username not in self.access_tokens:
+                if tokens.load_access_token(self, username, current_time):
+                    self.signal()
+
             # Refresh access token if necessary
             if (username not in self.access_tokens
                     or username not in self.access_token_expires_at_timestamp
@@ -204,19 +457,24 @@ class PlaceClient:
                     )):
                 logger.debug("Thread {}: Refreshing access token", username)
                 connect.login(self, username, password, username, current_time)
+                self.signal()
 
             # get current pixel position from input image and replacement color
-            relative, new_rgb = self.get_wrong_pixel(username)
-            target_rgb = self.template[relative[0], relative[1], :-1]
-            board_rgb = self.board[relative[0], relative[1], :]
+            pixel = self.get_wrong_pixel(username)
+            if pixel is None:
+                return  # stopped
+            coord, color_id = pixel
+            board_color_id = self.board_subscriber.color_at(coord)
 
             # draw the pixel onto r/place
             logger.info("Thread {} :: PLACING ::", username)
-            next_placement_time = self.set_pixel_and_check_ratelimit(
-                ColorMapper.rgb_to_id(new_rgb),
-                self.coord + relative, username,
-                new_rgb, target_rgb, board_rgb
-            )
+            try:
+                next_placement_time = self.set_pixel_and_check_ratelimit(
+                    color_id, coord, username, board_color_id
+                )
+            finally:
+                # Handed out again if the placement failed
+                self.release_pixel(coord)
 
             # next time until drawing with random offset to try dodging shadow bans
             time_to_wait = next_placement_time - current_time + np.random.randint(30, 180)
@@ -238,6 +496,11 @@ class PlaceClient:
         threads = {}
         i = 0
 
+        # Only the dispatcher updates the board and template
+        dispatcher = threading.Thread(target=self.dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
         try:
             while True:
                 i += 1
@@ -265,23 +528,26 @@ class PlaceClient:
                     # Reduce CPU usage
                     time.sleep(self.config_get("thread_delay") or 3)
 
-                # Update board image every seconds
-                logger.debug("Main: Allowing board image update")
-                self.board_outdated.set()
-
                 # Check if any threads are alive
                 if not any(thread.is_alive() for thread in threads.values()):
                     logger.warning("Main: All threads died")
                     break
+                if not dispatcher.is_alive():
+                    logger.warning("Main: Dispatcher died")
+                    break
+
+                # Log the progress of every template about every minute
+                if i % 20 == 0:
+                    self.log_template_stats()
 
                 # Update template image and canvas offsets every 3-4 minutes
                 if i % 100 == 0:
                     logger.debug("Main: Allowing template image and canvas offsets update")
-                    self.template_outdated.set()
+                    self.signal(self.template_outdated)
         # Check for ctrl+c
         except KeyboardInterrupt:
             logger.warning("Main: KeyboardInterrupt received, killing threads...")
-            self.stop_event.set()
+            self.signal(self.stop_event)
             logger.warning("Main: Threads killed, exiting...")
             for thread in threads:
                 thread.join()
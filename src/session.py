@@ -0,0 +1,21 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Shared keep-alive sessions, by purpose
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(key, pool_size=10) -> requests.Session:
+    """Keep-alive session shared by every caller using key, created on first use."""
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+        return session
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+
+# Serializes the writes of the worker threads to the token store
+_store_lock = threading.Lock()
+
+
+def _store_path(self):
+    return self.config_get("token_store", "tokens.json")
+
+
+def _read_store(self) -> dict:
+    path = _store_path(self)
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        self.logger.warning("Failed to read token store {}: {}", path, e)
+        return {}
+
+
+def _write_store(self, tokens: dict):
+    path = _store_path(self)
+    temp_path = path + ".tmp"
+    # Only readable by the owner, the tokens give access to the accounts
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(tokens, f)
+    os.chmod(temp_path, 0o600)
+    os.replace(temp_path, path)
+
+
+def load_access_token(self, username, current_time) -> bool:
+    """Use the stored access token of username if not expired, True if found."""
+    token = _read_store(self).get(username)
+    try:
+        access_token = token["access_token"]
+        expires_at = token["expires_at"]
+        if current_time >= expires_at:
+            return False
+    except (KeyError, TypeError):
+        # missing or malformed entry
+        return False
+    self.access_tokens[username] = access_token
+    self.access_token_expires_at_timestamp[username] = expires_at
+    self.logger.debug("Thread {}: Using stored access token", username)
+    return True
+
+
+def save_access_token(self, username):
+    """Store the current access token of username."""
+    if not _store_path(self):
+        return
+    with _store_lock:
+        tokens = _read_store(self)
+        tokens[username] = {
+            "access_token": self.access_tokens[username],
+            "expires_at": self.access_token_expires_at_timestamp[username],
+        }
+        _write_store(self, tokens)
+
+
+def forget_access_token(self, username):
+    """Expire the access token of username, in memory and in the store."""
+    # kept in access_tokens, the board subscription may still be using it
+    self.access_token_expires_at_timestamp[username] = time.time()
+    if not _store_path(self):
+        return
+    with _store_lock:
+        tokens = _read_store(self)
+        if tokens.pop(username, None) is not None:
+            _write_store(self, tokens)
@@ -1,10 +1,18 @@
 import numpy as np
+import hashlib
 import json
 import os
 import requests
+import tempfile
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from PIL import Image, UnidentifiedImageError
 from io import BytesIO
 
+import src.session as session
+from src.mappings import ColorMapper
+
 
 def clear():
     os.system("cls||clear")
@@ -26,30 +34,140 @@ def get_json_data(self, config_path):
     # Read the input image.jpg file
 
 
+# Paths of the cached body and validators of url in "template_cache_dir"
+def _cache_paths(self, url):
+    cache_dir = self.config_get("template_cache_dir", "cache/templates")
+    if not cache_dir:
+        return None, None
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return (
+        os.path.join(cache_dir, key + ".bin"),
+        os.path.join(cache_dir, key + ".json"),
+    )
+
+
+# Write data to path atomically, so a crash never leaves a partial cache entry
+# Every write has its own temporary file, the same url may be fetched concurrently
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+# Cached validators of a url, None if not cached or unreadable
+def _read_meta(self, meta_path):
+    if meta_path is None or not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        self.logger.warning("Ignoring unreadable cache entry {}: {}", meta_path, e)
+        return None
+
+
+# Get the body of url over the shared template session
+# "template_timeout" bounds the connection and every read, "template_deadline"
+# the whole download
+# The body is returned as parsed by parse, which raises ValueError / OSError if
+# it is invalid. Bodies are cached on disk with their ETag / Last-Modified once
+# they parse, the request is conditional when cached and the cached body is used
+# on 304 or on failure
+def fetch_url(self, url, parse=bytes):
+    body_path, meta_path = _cache_paths(self, url)
+    meta = _read_meta(self, meta_path)
+    cached = meta is not None
+    headers = {}
+    if cached:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        deadline = time.monotonic() + self.config_get("template_deadline", 60)
+        pool_size = self.config_get("template_download_threads", 8)
+        response = session.get_session("templates", pool_size).get(
+            url,
+            headers=headers,
+            timeout=self.config_get("template_timeout", 10),
+            stream=True,
+        )
+        # Read the body as it arrives, to give up on hosts sending it too slowly
+        # (read1 returns what is available, urllib3 >= 2)
+        read = getattr(response.raw, "read1", response.raw.read)
+        content = bytearray()
+        # closed even on error statuses, to give the connection back to the pool
+        with response:
+            if response.status_code != 304 or not cached:
+                response.raise_for_status()
+            while chunk := read(1 << 16, decode_content=True):
+                content += chunk
+                if time.monotonic() > deadline:
+                    raise requests.exceptions.Timeout(f"Download of {url} took too long")
+        content = bytes(content)
+    # the raw reads raise the urllib3 errors, not wrapped by requests
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        if not cached:
+            raise
+        self.logger.warning("Failed to fetch {}, using cached copy: {}", url, e)
+        response = None
+
+    if response is not None and response.status_code != 304:
+        try:
+            parsed = parse(content)
+        except (ValueError, OSError) as e:
+            if not cached:
+                raise
+            self.logger.warning("Invalid body from {}, using cached copy: {}", url, e)
+        else:
+            if body_path is not None:
+                _write_atomic(body_path, content)
+                _write_atomic(meta_path, json.dumps({
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }).encode())
+            return parsed
+
+    self.logger.debug("Using cached copy of {}", url)
+    with open(body_path, "rb") as f:
+        return parse(f.read())
+
+
 def get_json_from_url(self, url):
     # Get the json data from the url
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+        return fetch_url(self, url, json.loads)
+    except (requests.exceptions.RequestException, OSError, ValueError) as e:
         self.logger.exception(f"Error fetching data from {url}: {e}")
         return None
-    
-    return response.json()
+
+
+# Image decoded from body, fully read to find truncated images
+def _open_image(body):
+    image = Image.open(BytesIO(body))
+    image.load()
+    return image
 
 
 def load_image_from_url(self, url):
     # Get the image from the url
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-    except requests.exceptions.RequestException as e:
-        self.logger.exception(f"Error loading image from {url}: {e}")
-        return None
+        image = fetch_url(self, url, _open_image)
     except UnidentifiedImageError:
         self.logger.exception(f"Coudln't identify image format from {url}")
         return None
+    except (requests.exceptions.RequestException, OSError) as e:
+        self.logger.exception(f"Error loading image from {url}: {e}")
+        return None
     
     # Convert image to RGBA - Transparency should only be supported with PNG
     if image.mode != "RGBA":
@@ -60,12 +178,69 @@ def load_image_from_url(self, url):
     return image
 
 
-def load_template_data(self) -> tuple[np.ndarray, Image.Image]:
+# Template images as rgba arrays with their colors replaced by the closest palette colors
+# Quantized images are cached by content and palette, only new or changed
+# templates are quantized again. Returns the images and their cache keys.
+def quantize_templates(self, images):
+    # the palette may be updated by the board subscription meanwhile
+    colors = ColorMapper.COLORS
+    palette_key = ColorMapper.palette_key(colors)
+    quantized = []
+    keys = []
+    changed = 0
+    for image in images:
+        pixels = np.array(image)
+        key = (
+            hashlib.sha1(pixels.tobytes()).hexdigest(),
+            pixels.shape,
+            palette_key,
+        )
+        if key not in self.quantized_templates:
+            changed += 1
+            self.quantized_templates[key] = ColorMapper.correct_image(pixels, colors)
+        quantized.append(self.quantized_templates[key])
+        keys.append(key)
+    self.logger.debug(
+        "Quantized {} new or changed templates out of {}", changed, len(keys)
+    )
+    # Forget the templates not used anymore
+    for key in self.quantized_templates.keys() - set(keys):
+        del self.quantized_templates[key]
+    return quantized, keys
+
+
+# Result of a template download future, None if it failed or is not done by
+# deadline, so a bad source only skips itself
+def _download_result(self, future, deadline, url):
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except TimeoutError:
+        future.cancel()
+        self.logger.warning("Gave up waiting for {}", url)
+        return None
+    except Exception as e:
+        self.logger.exception("Failed to download {}: {}", url, e)
+        return None
+
+
+def load_template_data(self) -> tuple[np.ndarray, Image.Image, np.ndarray, list]:
     # Load the template images from the urls
-    templates = []
+    # Every source is fetched concurrently, a slow host only delays its own
+    # and is skipped once "template_deadline" has passed
+    executor = ThreadPoolExecutor(
+        max_workers=self.config_get("template_download_threads", 8)
+    )
     urls = self.config_get('template_urls')
-    for url in urls:
-        sources = get_json_from_url(self, url)
+    priority_url = self.config_get('priority_url')
+    deadline = time.monotonic() + self.config_get("template_deadline", 60)
+    source_futures = [executor.submit(get_json_from_url, self, url) for url in urls]
+    priority_future = (
+        executor.submit(get_json_from_url, self, priority_url) if priority_url else None
+    )
+
+    templates = []
+    for url, future in zip(urls, source_futures):
+        sources = _download_result(self, future, deadline, url)
         if not sources:
             continue  # skip
         templates += sources['templates']
@@ -73,13 +248,13 @@ def load_template_data(self) -> tuple[np.ndarray, Image.Image]:
     original_names = set(template['name'] for template in templates)
 
     priority_names = set()
-    try:
-        url = self.config_get('priority_url')
-        if url:
-            for priority_template in get_json_from_url(self, url)['templates']:
+    if priority_future is not None:
+        priority_sources = _download_result(self, priority_future, deadline, priority_url)
+        if priority_sources:
+            for priority_template in priority_sources['templates']:
                 priority_names.add(priority_template['name'])
-    except requests.exceptions.HTTPError:
-        self.logger.warning("Failed to load priority templates")
+        else:
+            self.logger.warning("Failed to load priority templates")
 
     # use priority unless nothing matches, then use names
     names = priority_names & original_names
@@ -96,38 +271,61 @@ def load_template_data(self) -> tuple[np.ndarray, Image.Image]:
         self.logger.warning("No template matches names")
 
     images = []
-    for sources in templates:
-        image = load_image_from_url(self, sources['sources'][0])
+    loaded = []
+    image_futures = [
+        executor.submit(load_image_from_url, self, sources['sources'][0])
+        for sources in templates
+    ]
+    executor.shutdown(wait=False)
+    deadline = time.monotonic() + self.config_get("template_deadline", 60)
+    for sources, future in zip(templates, image_futures):
+        image = _download_result(self, future, deadline, sources['sources'][0])
         if not image:
             self.logger.warning("Failed to load image for template {}", sources['name'])
             continue  # skip
         images.append(image)
+        loaded.append(sources)
     
     if not images:
         self.logger.error("Empty templates")
         return None
 
+    # Replace the colors of every template by the closest palette colors
+    images, keys = quantize_templates(self, images)
+
     # Compute dimensions
     coords = np.array([(template['x'], template['y'])
-                       for template in templates])
-    sizes = np.array([image.size for image in images])
+                       for template in loaded])
+    sizes = np.array([image.shape[1::-1] for image in images])
     dims = coords + sizes
-    # Starting position
+    # Bounding box of all templates
     coord = np.min(coords, axis=0)
     dim = np.max(dims, axis=0)
 
-    # Combine all images
-    image = Image.new('RGBA', (*dim,))  # canvas in RGBA
-    for i, c in zip(images[::-1], coords[::-1]):
-        image.paste(i, (*c,), i)
-    image = image.crop((*coord, *dim))
+    # Combine all images into a buffer covering only the bounding box
+    width, height = dim - coord
+    composite = np.zeros((height, width, 4), dtype=np.uint8)
+    # label of the template each pixel comes from, position in names + 1, 0 if none
+    labels = np.zeros((height, width), dtype=np.uint16)
+    names = [template['name'] for template in loaded]
+    # first templates are drawn over the following ones
+    for label, i, c in zip(range(len(images), 0, -1), images[::-1], coords[::-1]):
+        x, y = c - coord
+        area = (slice(y, y + i.shape[0]), slice(x, x + i.shape[1]))
+        visible = i[..., 3] > 0
+        composite[area][visible] = i[visible]
+        labels[area][visible] = label
+    image = Image.fromarray(composite)
 
     self.logger.info("Loaded image size: {}", image.size)
 
-    # Save the template image
+    # Save the template image, unless the same templates were saved last time
     path = self.config_get('image_path')
-    image.save(path)
-    self.logger.info("Saved template image to {}", path)
+    template_key = (path, tuple(keys), coords.tobytes(), tuple(names))
+    if template_key != self.template_key:
+        image.save(path)
+        self.template_key = template_key
+        self.logger.info("Saved template image to {}", path)
 
     # TEMPLATE API COORDS
-    return coord, image
+    return coord, image, labels, names